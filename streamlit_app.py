@@ -1,7 +1,13 @@
+import bisect
+from abc import ABC, abstractmethod
+import os
+import sqlite3
+import stat
+import threading
+import uuid
 import streamlit as st
 import pandas as pd
-import plotly.express as px
-from datetime import datetime
+from datetime import date, datetime
 import numpy as np
 
 # Set page config
@@ -27,34 +33,391 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
-# Initialize session state for data storage
-if 'measurements' not in st.session_state:
-    st.session_state.measurements = {}
+# Maximum number of points sent to the trend chart
+MAX_CHART_POINTS = 500
+# Histories spanning more than this many days are charted as daily maxima
+DAILY_SPAN_DAYS = 365
+# Upper bound for lesion counts, which are stored as int16
+MAX_LESION_COUNT = int(np.iinfo(np.int16).max)
+
+# Storage backend: "session" (default) or "sqlite"
+STORAGE_BACKEND = os.environ.get("JC_STORAGE", "session")
+DB_PATH = os.environ.get("JC_DB_PATH", "jc_index.db")
+FEATHER_PATH = os.environ.get("JC_FEATHER_PATH", "measurements.feather")
+
+# Risk thresholds: values at or above a bin edge fall into the next label
+_RISK_BINS = np.array([3.5, 4.0])
+_RISK_LABELS = np.array(["LOW", "MEDIUM", "HIGH"])
+
+# Risk card colour and markup
+RISK_COLOR = {
+    "LOW": "green",
+    "MEDIUM": "yellow",
+    "HIGH": "red"
+}
+_RISK_HTML = """
+        <div style='padding: 1rem; border-radius: 0.5rem; 
+        background-color: {color}33; 
+        color: {color}; text-align: center;'>
+        <h3>Risk Level</h3>
+        <h2>{level}</h2>
+        </div>
+        """
+
+# Calculate risk levels for an array of JC index values
+def calculate_risk_vec(jc_index):
+    return _RISK_LABELS[np.searchsorted(_RISK_BINS, np.asarray(jc_index), side='right')]
 
 # Calculate risk level
 def calculate_risk(jc_index):
-    if jc_index >= 4.0:
-        return "HIGH"
-    elif jc_index >= 3.5:
-        return "MEDIUM"
-    return "LOW"
-
-# Save measurement
-def save_measurement(data):
-    if data['patient_id'] not in st.session_state.measurements:
-        st.session_state.measurements[data['patient_id']] = []
-    
-    data['risk_level'] = calculate_risk(data['jc_index'])
-    st.session_state.measurements[data['patient_id']].append(data)
+    return str(calculate_risk_vec(jc_index))
 
-# Load measurements
-def load_measurements(patient_id):
-    if patient_id not in st.session_state.measurements:
-        return pd.DataFrame()
-    
-    df = pd.DataFrame(st.session_state.measurements[patient_id])
-    df['scan_date'] = pd.to_datetime(df['scan_date'])
-    return df.sort_values('scan_date')
+# Add derived columns and compact dtypes to a loaded, date-sorted frame
+def finalize_frame(df):
+    df['risk_level'] = calculate_risk_vec(df['jc_index'])
+    return df.astype({
+        'total_lesions': 'int16',
+        'new_lesions': 'int16',
+        'risk_level': 'category',
+        'patient_id': 'category'
+    })
+
+# Storage interface shared by the session-state and SQLite backends
+class Storage(ABC):
+    @abstractmethod
+    def save(self, data):
+        ...
+
+    # Full history for a patient, sorted by scan date
+    @abstractmethod
+    def load(self, patient_id):
+        ...
+
+    # The two most recent measurements (latest first) for the metric cards
+    @abstractmethod
+    def load_latest_two(self, patient_id):
+        ...
+
+    # scan_date/jc_index series for the trend chart, reduced to one point per
+    # day (the maximum) when the history spans more than DAILY_SPAN_DAYS
+    def load_trend(self, patient_id):
+        df = self.load(patient_id)
+        if df.empty:
+            return df
+        if (df['scan_date'].iloc[-1] - df['scan_date'].iloc[0]).days <= DAILY_SPAN_DAYS:
+            return df[['scan_date', 'jc_index']]
+        return (
+            df.groupby(df['scan_date'].dt.normalize())['jc_index']
+            .max()
+            .reset_index()
+        )
+
+# Process-wide lock for read-modify-write of the Feather file; Streamlit runs
+# each session in its own thread
+@st.cache_resource
+def get_feather_lock(feather_path):
+    return threading.Lock()
+
+# Measurements kept in st.session_state and mirrored to a Feather file, so a
+# new session starts from a single columnar read instead of an empty dict.
+# The session's copy is reloaded whenever the file changes, so rows saved by
+# other sessions show up without a page reload.
+class SessionStorage(Storage):
+    def __init__(self, feather_path):
+        self.feather_path = feather_path
+        self._refresh()
+
+    # (mtime, size) of the Feather file, or None if it does not exist yet
+    def _file_version(self):
+        try:
+            info = os.stat(self.feather_path)
+        except FileNotFoundError:
+            return None
+        return (info.st_mtime_ns, info.st_size)
+
+    # Reload the session's rows if the file changed since they were read
+    def _refresh(self):
+        version = self._file_version()
+        if 'measurements' in st.session_state and st.session_state.feather_version == version:
+            return
+        st.session_state.measurements = self._read_feather()
+        st.session_state.frames = {}
+        st.session_state.feather_version = version
+
+    # Per-patient row lists, sorted by scan date, from the Feather file
+    def _read_feather(self):
+        if not os.path.exists(self.feather_path):
+            return {}
+        df = pd.read_feather(self.feather_path).sort_values('scan_date', kind='stable')
+        return {
+            patient_id: group.to_dict('records')
+            for patient_id, group in df.groupby('patient_id', sort=False)
+        }
+
+    # Rewrites the whole file through a uniquely named temporary file so a
+    # crash mid-write never leaves a truncated log behind; the lock keeps
+    # concurrent sessions from dropping each other's rows
+    def _append_feather(self, row):
+        with get_feather_lock(self.feather_path):
+            df = pd.DataFrame([row])
+            if os.path.exists(self.feather_path):
+                df = pd.concat([pd.read_feather(self.feather_path), df], ignore_index=True)
+            # Created by to_feather with the usual umask-based mode, unlike
+            # tempfile's owner-only files; an existing file keeps its mode
+            tmp_path = f"{self.feather_path}.{uuid.uuid4().hex}.tmp"
+            try:
+                df.to_feather(tmp_path)
+                if os.path.exists(self.feather_path):
+                    os.chmod(tmp_path, stat.S_IMODE(os.stat(self.feather_path).st_mode))
+                os.replace(tmp_path, self.feather_path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+    # Rows are kept sorted by scan date on insert, so loading needs no sort.
+    # The file is written first so a failed write never shows as saved.
+    def save(self, data):
+        row = dict(data, scan_date=pd.Timestamp(data['scan_date']))
+        self._append_feather(row)
+
+        if data['patient_id'] not in st.session_state.measurements:
+            st.session_state.measurements[data['patient_id']] = []
+        
+        bisect.insort(
+            st.session_state.measurements[data['patient_id']],
+            row,
+            key=lambda r: r['scan_date']
+        )
+
+    # The frame is memoized per patient and keyed on the row count, so reruns
+    # triggered by unrelated widgets reuse it instead of rebuilding it.
+    def load(self, patient_id):
+        self._refresh()
+        if patient_id not in st.session_state.measurements:
+            return pd.DataFrame()
+        
+        rows = st.session_state.measurements[patient_id]
+        key = (patient_id, len(rows))
+        cached = st.session_state.frames.get(patient_id)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        
+        df = finalize_frame(pd.DataFrame(rows))
+        st.session_state.frames[patient_id] = (key, df)
+        return df
+
+    def load_latest_two(self, patient_id):
+        self._refresh()
+        rows = st.session_state.measurements.get(patient_id, [])
+        return rows[-2:][::-1]
+
+# Shared SQLite connection, opened once per process and reused across reruns
+@st.cache_resource
+def get_conn(db_path):
+    conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+    conn.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA cache_size=-20000;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA mmap_size=134217728;
+        CREATE TABLE IF NOT EXISTS jc_measurements (
+            patient_id TEXT NOT NULL,
+            scan_date TEXT NOT NULL,
+            jc_index REAL NOT NULL,
+            total_lesions INTEGER NOT NULL,
+            new_lesions INTEGER NOT NULL,
+            notes TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_patient_date
+            ON jc_measurements(patient_id, scan_date);
+        CREATE TABLE IF NOT EXISTS jc_daily (
+            patient_id TEXT NOT NULL,
+            day TEXT NOT NULL,
+            jc_max REAL NOT NULL,
+            jc_mean REAL NOT NULL,
+            lesions_total INTEGER NOT NULL,
+            n INTEGER NOT NULL,
+            PRIMARY KEY (patient_id, day)
+        );
+    """)
+    return conn
+
+# Process-wide lock for the shared connection; Streamlit runs each session in
+# its own thread, and a transaction on one connection is visible to them all
+@st.cache_resource
+def get_db_lock(db_path):
+    return threading.Lock()
+
+# Cached per patient and data version (see SQLiteStorage.data_version), so a
+# save moves readers to a new cache entry instead of relying on clear()
+@st.cache_data(show_spinner=False)
+def load_sqlite_frame(db_path, patient_id, version):
+    with get_db_lock(db_path):
+        df = pd.read_sql_query(
+            "SELECT patient_id, scan_date, jc_index, total_lesions, new_lesions, notes "
+            "FROM jc_measurements WHERE patient_id = ? ORDER BY scan_date, rowid",
+            get_conn(db_path),
+            params=(patient_id,),
+            parse_dates=['scan_date']
+        )
+    if df.empty:
+        return df
+    return finalize_frame(df)
+
+# Daily aggregates, cached per patient and data version
+@st.cache_data(show_spinner=False)
+def load_sqlite_daily(db_path, patient_id, version):
+    with get_db_lock(db_path):
+        return pd.read_sql_query(
+            "SELECT day AS scan_date, jc_max AS jc_index FROM jc_daily "
+            "WHERE patient_id = ? ORDER BY day",
+            get_conn(db_path),
+            params=(patient_id,),
+            parse_dates=['scan_date']
+        )
+
+# Measurements persisted to a local SQLite database
+# jc_daily holds per-day aggregates, updated in the same transaction as each
+# insert so long trends read O(days) rows instead of every scan.
+class SQLiteStorage(Storage):
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def save(self, data):
+        conn = get_conn(self.db_path)
+        day = data['scan_date'].isoformat()
+        with get_db_lock(self.db_path):
+            conn.execute("BEGIN")
+            try:
+                conn.execute(
+                    "INSERT INTO jc_measurements "
+                    "(patient_id, scan_date, jc_index, total_lesions, new_lesions, notes) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        data['patient_id'],
+                        day,
+                        data['jc_index'],
+                        data['total_lesions'],
+                        data['new_lesions'],
+                        data['notes']
+                    )
+                )
+                conn.execute(
+                    "INSERT INTO jc_daily VALUES (?, ?, ?, ?, ?, 1) "
+                    "ON CONFLICT(patient_id, day) DO UPDATE SET "
+                    "jc_max = max(jc_max, excluded.jc_max), "
+                    "jc_mean = (jc_mean * n + excluded.jc_mean) / (n + 1), "
+                    "lesions_total = lesions_total + excluded.lesions_total, "
+                    "n = n + 1",
+                    (
+                        data['patient_id'],
+                        day,
+                        data['jc_index'],
+                        data['jc_index'],
+                        data['total_lesions']
+                    )
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    # Row count and newest rowid for a patient; both change on every insert,
+    # and the query is served from idx_patient_date alone
+    def data_version(self, patient_id):
+        with get_db_lock(self.db_path):
+            return get_conn(self.db_path).execute(
+                "SELECT count(*), max(rowid) FROM jc_measurements WHERE patient_id = ?",
+                (patient_id,)
+            ).fetchone()
+
+    def load(self, patient_id):
+        return load_sqlite_frame(self.db_path, patient_id, self.data_version(patient_id))
+
+    def load_latest_two(self, patient_id):
+        with get_db_lock(self.db_path):
+            cursor = get_conn(self.db_path).execute(
+                "SELECT jc_index, total_lesions, new_lesions FROM jc_measurements "
+                "WHERE patient_id = ? ORDER BY scan_date DESC, rowid DESC LIMIT 2",
+                (patient_id,)
+            )
+            columns = [col[0] for col in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def load_trend(self, patient_id):
+        with get_db_lock(self.db_path):
+            first, last = get_conn(self.db_path).execute(
+                "SELECT min(day), max(day) FROM jc_daily WHERE patient_id = ?",
+                (patient_id,)
+            ).fetchone()
+        # No aggregates (e.g. rows written before jc_daily existed): chart raw scans
+        if first is None:
+            return self.load(patient_id)[['scan_date', 'jc_index']]
+        span = date.fromisoformat(last) - date.fromisoformat(first)
+        if span.days <= DAILY_SPAN_DAYS:
+            return self.load(patient_id)[['scan_date', 'jc_index']]
+        return load_sqlite_daily(self.db_path, patient_id, self.data_version(patient_id))
+
+if STORAGE_BACKEND == "sqlite":
+    storage = SQLiteStorage(DB_PATH)
+else:
+    storage = SessionStorage(FEATHER_PATH)
+
+# Downsample a series with Largest-Triangle-Three-Buckets
+# Returns the indices of the points to keep; first and last are always kept.
+def lttb_indices(x, y, n_out):
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.append(np.linspace(1, n - 1, n_out - 1).astype(np.int64), n)
+
+    keep = np.empty(n_out, dtype=np.int64)
+    keep[0] = 0
+    keep[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2]
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        area = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(area.argmax())
+        keep[i + 1] = a
+    return keep
+
+# Build the trend figure
+# Cached on the plotted arrays, so reruns with unchanged data reuse the figure.
+# The arrays go to a WebGL trace as-is, without conversion to Python lists.
+@st.cache_data(show_spinner=False)
+def build_trend_fig(scan_dates, jc_values):
+    # Imported here so pages without a chart skip loading plotly
+    import plotly.graph_objects as go
+
+    fig = go.Figure(go.Scattergl(
+        x=scan_dates,
+        y=jc_values,
+        mode='lines+markers',
+        name='jc_index'
+    ))
+    fig.update_layout(
+        title='JC Index Over Time',
+        xaxis_title="Date",
+        yaxis_title="JC Index",
+        yaxis_range=[0, 8],
+        hovermode='x unified',
+        showlegend=False
+    )
+    fig.add_hline(y=4.0, line_dash="dash", line_color="red", annotation_text="High Risk")
+    fig.add_hline(y=3.5, line_dash="dash", line_color="yellow", annotation_text="Medium Risk")
+    return fig
 
 # Title and patient selection
 st.title("JC Index Monitoring System")
@@ -71,21 +434,24 @@ with st.sidebar:
     - 🔴 High: > 4.0
     """)
 
-# Main layout
-col1, col2, col3 = st.columns(3)
+# Dashboard: metric cards and trend chart
+def render_dashboard(patient_id):
+    col1, col2, col3 = st.columns(3)
 
-# Load patient data
-df = load_measurements(patient_id)
+    # Load the latest rows for the metric cards
+    latest_two = storage.load_latest_two(patient_id)
+    if not latest_two:
+        return
 
-if not df.empty:
-    latest = df.iloc[-1]
+    latest = latest_two[0]
+    risk_level = calculate_risk(latest['jc_index'])
     
     # Current JC Index
     with col1:
         st.metric(
             label="Current JC Index",
             value=f"{latest['jc_index']:.1f}",
-            delta=f"{latest['jc_index'] - df.iloc[-2]['jc_index']:.1f}" if len(df) > 1 else None,
+            delta=f"{latest['jc_index'] - latest_two[1]['jc_index']:.1f}" if len(latest_two) > 1 else None,
             delta_color="inverse"
         )
 
@@ -99,39 +465,26 @@ if not df.empty:
 
     # Risk Level
     with col3:
-        risk_color = {
-            "LOW": "green",
-            "MEDIUM": "yellow",
-            "HIGH": "red"
-        }
-        st.markdown(f"""
-        <div style='padding: 1rem; border-radius: 0.5rem; 
-        background-color: {risk_color[latest['risk_level']]}33; 
-        color: {risk_color[latest['risk_level']]}; text-align: center;'>
-        <h3>Risk Level</h3>
-        <h2>{latest['risk_level']}</h2>
-        </div>
-        """, unsafe_allow_html=True)
+        st.markdown(
+            _RISK_HTML.format(color=RISK_COLOR[risk_level], level=risk_level),
+            unsafe_allow_html=True
+        )
 
     # Trend Chart
     st.subheader("JC Index Trend")
-    fig = px.line(
-        df, 
-        x='scan_date', 
-        y='jc_index',
-        markers=True,
-        title='JC Index Over Time'
-    )
-    fig.update_layout(
-        xaxis_title="Date",
-        yaxis_title="JC Index",
-        yaxis_range=[0, 8],
-        hovermode='x unified',
-        showlegend=False
-    )
-    fig.add_hline(y=4.0, line_dash="dash", line_color="red", annotation_text="High Risk")
-    fig.add_hline(y=3.5, line_dash="dash", line_color="yellow", annotation_text="Medium Risk")
-    st.plotly_chart(fig, use_container_width=True)
+    df = storage.load_trend(patient_id)
+    if len(df) > MAX_CHART_POINTS:
+        keep = lttb_indices(
+            df['scan_date'].values.astype('int64'),
+            df['jc_index'].values,
+            MAX_CHART_POINTS
+        )
+        df = df.iloc[keep]
+    fig = build_trend_fig(df['scan_date'].values, df['jc_index'].values)
+    # A stable per-patient key lets the browser update the existing chart
+    st.plotly_chart(fig, use_container_width=True, key=f"trend_{patient_id}")
+
+render_dashboard(patient_id)
 
 # Data Entry Form
 st.subheader("Enter New Measurement")
@@ -155,11 +508,13 @@ with st.form("measurement_form"):
         total_lesions = st.number_input(
             "Total Lesions",
             min_value=0,
+            max_value=MAX_LESION_COUNT,
             step=1
         )
         new_lesions = st.number_input(
             "New Lesions",
             min_value=0,
+            max_value=MAX_LESION_COUNT,
             step=1
         )
     
@@ -177,7 +532,7 @@ with st.form("measurement_form"):
                 'new_lesions': new_lesions,
                 'notes': notes
             }
-            save_measurement(new_data)
+            storage.save(new_data)
             st.success("✅ Measurement saved successfully!")
             st.rerun()
         else:
@@ -186,18 +541,25 @@ with st.form("measurement_form"):
 # Data Management Section
 st.markdown("---")
 st.subheader("Data Management")
-col1, col2 = st.columns(2)
-
-with col1:
-    if st.checkbox("Show raw data"):
-        st.dataframe(df)
-
-with col2:
-    if not df.empty:
-        csv = df.to_csv(index=False)
-        st.download_button(
-            label="📥 Download Data as CSV",
-            data=csv,
-            file_name=f"jc_index_data_{patient_id}.csv",
-            mime="text/csv"
-        )
+
+# Runs as a fragment so toggling the raw data view reruns only this section
+# and does not rebuild the chart
+@st.fragment
+def render_data_management(patient_id):
+    col1, col2 = st.columns(2)
+
+    with col1:
+        if st.checkbox("Show raw data"):
+            st.dataframe(storage.load(patient_id))
+
+    with col2:
+        if storage.load_latest_two(patient_id):
+            # Load the history and build the CSV only when the button is clicked
+            st.download_button(
+                label="📥 Download Data as CSV",
+                data=lambda: storage.load(patient_id).to_csv(index=False).encode(),
+                file_name=f"jc_index_data_{patient_id}.csv",
+                mime="text/csv"
+            )
+
+render_data_management(patient_id)